@@ -1,16 +1,72 @@
 import os
+import asyncio
+import contextlib
+import functools
+import hashlib
 import httpx
-import json 
-from pydantic import BaseModel
-from typing import AsyncGenerator, Optional, Any, Dict
+import json
+import orjson
+import logging
+import queue
+import re
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated, AsyncGenerator, AsyncIterator, Optional, Any, Dict
 
 from fastapi import FastAPI, HTTPException, Path, Request, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 
 WREN_BASE_URL = "https://cloud.getwren.ai/api/v1"
 
-app = FastAPI(title="Wren AI Core Proxy Server")
+# 日誌經由 queue 交給背景執行緒輸出，避免在 event loop 上做阻塞的 I/O
+# 設定 WREN_PROXY_LOG_LEVEL=DEBUG 可查看送往 Wren 的 payload
+logger = logging.getLogger("wren_proxy")
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+
+# 無效的等級名稱不應讓程式無法啟動，改用 INFO 並記錄警告
+_log_level = os.getenv("WREN_PROXY_LOG_LEVEL", "INFO").upper()
+if _log_level in logging.getLevelNamesMapping():
+    logger.setLevel(_log_level)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("Invalid WREN_PROXY_LOG_LEVEL %r, falling back to INFO", _log_level)
+
+# 連線/讀取/寫入/取得連線分開計時；pool 設短，連線池滿載時快速回 503 而不是排隊等待
+WREN_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=2.0)
+VALIDATE_TIMEOUT = httpx.Timeout(connect=5.0, read=10.0, write=10.0, pool=2.0)
+# 串流生成時間不定，讀取不設上限
+STREAM_TIMEOUT = httpx.Timeout(connect=5.0, read=None, write=10.0, pool=2.0)
+
+# 共用的 HTTP 連線池，於啟動時建立、關閉時釋放，避免每次請求重新做 TCP+TLS 握手
+CLIENT: httpx.AsyncClient = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global CLIENT
+    _log_listener.start()
+    CLIENT = httpx.AsyncClient(
+        base_url=WREN_BASE_URL,
+        timeout=WREN_TIMEOUT,
+        # 串流請求會在整個生成期間佔住連線，因此保留較多的 keep-alive 連線
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0),
+        # HTTP/2 讓多個並行請求共用同一條 TLS 連線 (需安裝 h2)
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await CLIENT.aclose()
+        _log_listener.stop()
+
+app = FastAPI(title="Wren AI Core Proxy Server", lifespan=lifespan)
 
 # 允許跨域請求 (CORS)
 app.add_middleware(
@@ -23,59 +79,117 @@ app.add_middleware(
 
 # 定義請求體 (Request Body) 的結構
 class WrenRequest(BaseModel):
-    # 統一使用 project_id
-    project_id: Optional[str] = None 
+    # 統一使用 project_id；由 Pydantic (Rust core) 在驗證時去除前後空白，handler 不必再 strip()
+    # 只處理 project_id，text 與 additional_payload 維持原樣轉送
+    project_id: Optional[Annotated[str, StringConstraints(strip_whitespace=True)]] = None 
     text: Optional[str] = None
     additional_payload: Dict[str, Any] = {}
 
 # --- 共用 HTTP 請求函數 ---
 
+@functools.lru_cache(maxsize=512)
+def _auth_headers(wren_api_key: str) -> Dict[str, str]:
+    """依 API Key 快取請求 headers；回傳的 dict 為共用物件，請勿修改。"""
+    return {
+        "Authorization": f"Bearer {wren_api_key}",
+        "Content-Type": "application/json",
+    }
+
+@functools.lru_cache(maxsize=512)
+def _stream_headers(wren_api_key: str) -> Dict[str, str]:
+    """串流請求用的 headers (同樣快取，請勿修改)。"""
+    return {
+        **_auth_headers(wren_api_key),
+        "Accept": "text/event-stream",
+        # aiter_raw 不做解壓縮，要求上游不要壓縮以便原樣轉送
+        "Accept-Encoding": "identity",
+    }
+
+def _dumps_payload(payload: Dict[str, Any]) -> bytes:
+    """以 orjson 序列化送往 Wren 的 JSON Body；orjson 不支援超過 64-bit 的整數，此時改用標準 json 模組。"""
+    try:
+        return orjson.dumps(payload)
+    except orjson.JSONEncodeError:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# 由 proxy 填入的欄位，不允許 additional_payload 覆寫
+RESERVED_PAYLOAD_KEYS = frozenset({"question", "text", "projectId"})
+
+def _build_wren_payload(request_data: Optional[WrenRequest]) -> Dict[str, Any]:
+    """檢查 project_id 並組出送往 Wren 的 JSON Body (兩個 proxy route 共用)。"""
+
+    # 檢查 project_id 是否存在
+    if request_data is None or not request_data.project_id:
+        raise HTTPException(status_code=400, detail="project_id is required in the request body.")
+
+    try:
+        # 將 project_id 轉換為整數
+        project_id_int = int(request_data.project_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="project_id must be a valid integer.")
+
+    reserved = RESERVED_PAYLOAD_KEYS & request_data.additional_payload.keys()
+    if reserved:
+        raise HTTPException(
+            status_code=400,
+            detail=f"additional_payload must not contain reserved keys: {', '.join(sorted(reserved))}"
+        )
+
+    # project_id 放回 JSON Body 並強制轉為 int
+    wren_payload = {
+        **request_data.additional_payload, 
+        "question": request_data.text,
+        "text": request_data.text,
+        "projectId": project_id_int, 
+    }
+    return wren_payload
+
+# 上游回傳空 body 時給前端的固定訊息 (預先編碼)
+EMPTY_RESULT_BODY = orjson.dumps({"message": "Operation successful, no content returned."})
+
 async def async_wren_call(
     method: str,
-    full_url: str,
+    url: str,
     json_data: Optional[Dict[str, Any]] = None,
     wren_api_key: str = None
-) -> Dict[str, Any]:
-    """執行非串流的 HTTP 請求。"""
-
-    headers = {
-        "Authorization": f"Bearer {wren_api_key}",
-        "Content-Type": "application/json",
-    }
+) -> Response:
+    """執行非串流的 HTTP 請求，成功時直接轉送上游的 body bytes。"""
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            print("-" * 50)
-            print(f"DEBUG: Final Payload sent to Wren: {json_data}") 
-            print(f"DEBUG: Request URL: {full_url}") 
-            print("-" * 50)
-            
-            kwargs = {"headers": headers}
-            if json_data is not None and method.upper() in ["POST", "PUT", "PATCH"]:
-                kwargs["json"] = json_data
-            
-            response = await getattr(client, method.lower())(
-                full_url, 
-                **kwargs
-            )
-            
-            response.raise_for_status()
-            
-            if response.status_code == 204 or response.content == b'':
-                return {"message": "Operation successful, no content returned."}
-            
-            return response.json()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Final Payload sent to Wren: %s, Request URL: %s", json_data, url)
+        
+        kwargs = {"headers": _auth_headers(wren_api_key)}
+        if json_data is not None and method.upper() in ["POST", "PUT", "PATCH"]:
+            # 以 orjson 預先序列化，避免 httpx 使用較慢的標準 json 模組
+            kwargs["content"] = _dumps_payload(json_data)
+        
+        response = await CLIENT.request(method, url, **kwargs)
+        
+        response.raise_for_status()
+        
+        body = response.content
+        if not body or response.status_code == 204:
+            return Response(content=EMPTY_RESULT_BODY, media_type="application/json")
+        
+        # 純 proxy：不解析也不重新編碼，原樣回傳上游 JSON；只有錯誤時才解析 body 取出 detail
+        return Response(
+            content=body,
+            status_code=response.status_code,
+            media_type=response.headers.get("content-type", "application/json"),
+        )
             
     except httpx.HTTPStatusError as e:
-        error_content = e.response.text
-        print(f"Wren API Error: {error_content}")
+        body = e.response.content
+        error_content = body.decode(errors="replace")
+        logger.warning("Wren API Error: %s", error_content)
 
         try:
-            error_data = e.response.json()
+            error_data = orjson.loads(body)
             error_detail = error_data.get('detail', error_content)
             
             if isinstance(error_detail, dict) or isinstance(error_detail, list):
-                display_detail = json.dumps(error_detail)
+                display_detail = orjson.dumps(error_detail).decode()
             else:
                 display_detail = str(error_detail)
 
@@ -86,12 +200,18 @@ async def async_wren_call(
             status_code=e.response.status_code, 
             detail=f"Wren API Request Failed (Method: {method}, Status: {e.response.status_code}): {display_detail}"
         )
+    except httpx.PoolTimeout:
+        raise HTTPException(status_code=503, detail="Upstream saturated")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"內部伺服器錯誤: {str(e)}")
 
 
 # --- Route 1: Validate API Key (使用 /projects/{projectId} 驗證) ---
 
+# 快取驗證成功的 (Key, Project ID) 與上游回傳的 body bytes，60 秒內重複驗證不再呼叫上游；失敗結果不快取
+# 此快取以 API Key 的 blake2b 雜湊作為 key 的一部分 (固定長度)；原始 Key 仍會保留在 _auth_headers 的 lru_cache 中
+_validate_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
 @app.get("/api/validate-key")
 async def validate_api_key_and_project(
     wren_api_key: str = Header(..., alias="X-Wren-API-Key"),
@@ -99,18 +219,23 @@ async def validate_api_key_and_project(
     project_id: str = Query(..., description="Project ID to validate")
 ):
     """Verifies Key and Project ID by fetching project metadata."""
-    wren_full_url = f"{WREN_BASE_URL}/projects/{project_id.strip()}"
+    wren_api_key = wren_api_key.strip()
+    project_id = project_id.strip()
+
+    cache_key = (hashlib.blake2b(wren_api_key.encode(), digest_size=16).digest(), project_id)
+    cached = _validate_cache.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    # 與其他 route 相同，加上前導 "/" 確保一定是 base_url 下的相對路徑
+    wren_url = f"/projects/{project_id}"
 
-    headers = {
-        "Authorization": f"Bearer {wren_api_key.strip()}",
-        "Content-Type": "application/json",
-    }
-    
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(wren_full_url, headers=headers)
-            response.raise_for_status()
-            return response.json()
+        response = await CLIENT.get(wren_url, headers=_auth_headers(wren_api_key), timeout=VALIDATE_TIMEOUT)
+        response.raise_for_status()
+        # 上游已是 JSON，直接轉送 bytes，不做解析與重新編碼
+        _validate_cache[cache_key] = response.content
+        return Response(content=response.content, media_type="application/json")
             
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
@@ -121,6 +246,8 @@ async def validate_api_key_and_project(
              raise HTTPException(status_code=404, detail="Project ID 不存在或 Key 無法存取。")
         else:
             raise HTTPException(status_code=e.response.status_code, detail=f"Wren API 請求失敗: {e.response.text}")
+    except httpx.PoolTimeout:
+        raise HTTPException(status_code=503, detail="Upstream saturated")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"內部伺服器錯誤: {str(e)}")
 
@@ -136,81 +263,135 @@ async def handle_wren_query(
 ):
     """Proxies non-streaming requests to Wren AI Cloud API."""
     
-    # 檢查 project_id 是否存在
-    if not request_data.project_id or not request_data.project_id.strip():
-        raise HTTPException(status_code=400, detail="project_id is required in the request body.")
-
-    wren_full_url = f"{WREN_BASE_URL}/{endpoint_path}"
-
-    try:
-        # 將 project_id 轉換為整數
-        project_id_int = int(request_data.project_id.strip())
-    except ValueError:
-        raise HTTPException(status_code=400, detail="project_id must be a valid integer.")
-
-    # project_id 放回 JSON Body 並強制轉為 int
-    wren_payload = {
-        "question": request_data.text,
-        "text": request_data.text,
-        **request_data.additional_payload, 
-        "projectId": project_id_int, 
-    }
+    # 一律加上前導 "/" 成為相對路徑：endpoint_path 來自使用者，若直接傳入絕對 URL
+    # (例如 http://internal.svc/) httpx 會忽略 base_url，導致請求被導向其他主機
+    wren_url = f"/{endpoint_path}"
+    wren_payload = _build_wren_payload(request_data)
 
     return await async_wren_call(
         method=request.method,
-        full_url=wren_full_url,
+        url=wren_url,
         json_data=wren_payload,
         wren_api_key=wren_api_key.strip()
     )
 
 # --- Route 3: Streaming API Call (/stream/ask) ---
 
+# 串流錯誤時最多讀取的上游 body 長度 (bytes)
+MAX_ERROR_BYTES = 4096
+
+# SSE error 事件的固定框架；內容直接使用 orjson 產生的 bytes 拼接，不再經過 str 編碼
+SSE_ERROR_PREFIX = b"event: error\ndata: "
+SSE_EVENT_END = b"\n\n"
+
+# 合併零碎的上游 chunk 再送出，減少 ASGI send 次數；一旦出現完整的 SSE 事件結尾就立即送出，
+# 否則最多累積 STREAM_FLUSH_BYTES，或暫留 STREAM_FLUSH_INTERVAL 秒後送出 (由計時器保證)
+STREAM_FLUSH_BYTES = 4096
+STREAM_FLUSH_INTERVAL = 0.005
+
+# SSE 允許 LF、CRLF、CR 三種換行，連續兩個換行 (空行) 即為事件結尾
+SSE_EVENT_END_RE = re.compile(rb"\r\n\r\n|\n\r\n|\r\n\n|\n\n|\r\r")
+# 事件結尾最長 4 bytes，保留前一次讀取最後 (尚未構成結尾的) 3 bytes 以找出跨讀取被切開的結尾
+SSE_EVENT_END_TAIL = 3
+
+# 避免 Nginx 等反向代理緩衝或快取 SSE，確保 token 即時送達前端
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
+async def _coalesce_stream(chunks: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    """合併上游 chunk：遇到事件結尾、累積達上限或等待逾時就送出目前的 buffer。"""
+    loop = asyncio.get_running_loop()
+    chunks = chunks.__aiter__()
+    buf = bytearray()
+    tail = b""
+    deadline = None
+    # 下一個 chunk 的讀取放在獨立 task 中，逾時只送出 buffer 而不取消讀取，避免中斷上游串流
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(chunks.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield bytes(buf)
+                buf.clear()
+                deadline = None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+
+            buf += chunk
+            # tail 只保留最後一個事件結尾之後的 bytes，已送出的結尾不會被重複計算
+            window = tail + chunk
+            last_end = -1
+            for match in SSE_EVENT_END_RE.finditer(window):
+                last_end = match.end()
+            tail = window[max(last_end, len(window) - SSE_EVENT_END_TAIL):]
+            if last_end != -1 or len(buf) >= STREAM_FLUSH_BYTES:
+                yield bytes(buf)
+                buf.clear()
+                deadline = None
+            elif deadline is None:
+                deadline = loop.time() + STREAM_FLUSH_INTERVAL
+        if buf:
+            yield bytes(buf)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            with contextlib.suppress(asyncio.CancelledError, StopAsyncIteration):
+                await pending
+
 async def stream_wren_response(
-    wren_full_url: str, 
+    wren_url: str, 
     wren_payload: dict,
     wren_api_key: str
 ) -> AsyncGenerator[bytes, None]:
     """Handles SSE streaming response from Wren AI."""
     
-    headers = {
-        "Authorization": f"Bearer {wren_api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    print("-" * 50)
-    print(f"DEBUG: Final Streaming Payload sent to Wren: {wren_payload}")
-    print(f"DEBUG: Request URL: {wren_full_url}") 
-    print("-" * 50)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Final Streaming Payload sent to Wren: %s, Request URL: %s", wren_payload, wren_url)
 
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        try:
-            async with client.stream("POST", wren_full_url, headers=headers, json=wren_payload) as response:
-                
-                # Critical Fix for ResponseNotRead: read error content on failure
-                if response.status_code >= 400:
-                    await response.aread()
-                    response.raise_for_status()
-                
-                # Iterate over the response chunks
-                async for chunk in response.aiter_bytes():
-                    yield chunk
-                    
-        except httpx.HTTPStatusError as e:
-            error_msg = f"Wren API Request Failed ({e.response.status_code}): {e.response.text}"
-            print(f"Wren API Error: {error_msg}")
+    try:
+        async with CLIENT.stream("POST", wren_url, headers=_stream_headers(wren_api_key), content=_dumps_payload(wren_payload), timeout=STREAM_TIMEOUT) as response:
             
-            # Yield error as an SSE event to the frontend
-            try:
-                error_data = json.loads(e.response.text)
-                display_error = json.dumps({"error": error_data}, indent=2)
-            except:
-                display_error = f'{{"error": "{e.response.text}"}}'
+            # 上游錯誤時只讀取有限長度的 body 供顯示，避免把過大的錯誤內容整份載入記憶體
+            if response.status_code >= 400:
+                err_bytes = bytearray()
+                async for chunk in response.aiter_raw():
+                    err_bytes += chunk
+                    if len(err_bytes) >= MAX_ERROR_BYTES:
+                        break
+                del err_bytes[MAX_ERROR_BYTES:]
+
+                # 只解析一次，log 與回傳前端共用同一份結果
+                try:
+                    error_data = orjson.loads(err_bytes)
+                except orjson.JSONDecodeError:
+                    error_data = err_bytes.decode(errors="replace")
+                logger.warning("Wren API Request Failed (%s): %s", response.status_code, error_data)
+
+                # Yield error as an SSE event to the frontend
+                yield SSE_ERROR_PREFIX + orjson.dumps({"error": error_data}) + SSE_EVENT_END
+                return
+            
+            # Forward upstream bytes without decoding. Not passing chunk_size: a fixed size
+            # would hold tokens until the buffer fills; _coalesce_stream bounds that instead.
+            async with contextlib.aclosing(_coalesce_stream(response.aiter_raw())) as chunks:
+                async for chunk in chunks:
+                    yield chunk
                 
-            yield f"event: error\ndata: {display_error}\n\n".encode("utf-8")
-        except Exception as e:
-            error_msg = f"Internal Server Error: {str(e)}"
-            print(error_msg)
-            yield f"event: error\ndata: {error_msg}\n\n".encode("utf-8")
+    except Exception as e:
+        logger.error("Internal Server Error: %s", e)
+        error_msg = f"Internal Server Error: {str(e)}"
+        yield SSE_ERROR_PREFIX + orjson.dumps({"error": error_msg}) + SSE_EVENT_END
 
 
 @app.post("/api/stream-call/{endpoint_path:path}")
@@ -221,27 +402,13 @@ async def handle_wren_streaming_query(
 ):
     """Proxies streaming (SSE) requests to Wren AI Cloud API."""
     
-    # 檢查 project_id 是否存在
-    if not request_data.project_id or not request_data.project_id.strip():
-        raise HTTPException(status_code=400, detail="project_id is required in the request body.")
-    
-    wren_full_url = f"{WREN_BASE_URL}/{endpoint_path}"
-    
-    try:
-        # 將 project_id 轉換為整數
-        project_id_int = int(request_data.project_id.strip())
-    except ValueError:
-        raise HTTPException(status_code=400, detail="project_id must be a valid integer.")
-    
-    # project_id 放回 JSON Body 並強制轉為 int
-    wren_payload = {
-        "question": request_data.text,
-        "text": request_data.text,
-        **request_data.additional_payload, 
-        "projectId": project_id_int, 
-    }
+    # 一律加上前導 "/" 成為相對路徑：endpoint_path 來自使用者，若直接傳入絕對 URL
+    # (例如 http://internal.svc/) httpx 會忽略 base_url，導致請求被導向其他主機
+    wren_url = f"/{endpoint_path}"
+    wren_payload = _build_wren_payload(request_data)
 
     return StreamingResponse(
-        stream_wren_response(wren_full_url, wren_payload, wren_api_key.strip()),
-        media_type="text/event-stream"
+        stream_wren_response(wren_url, wren_payload, wren_api_key.strip()),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
     )
\ No newline at end of file
@@ -1,4 +1,4 @@
-import requests
+import httpx
 import json
 
 # ⚠️ 替換成您的實際值
@@ -8,7 +8,8 @@ PROJECT_ID = "11237"
 # -----------------------------------------------
 
 # 構建目標 URL，將 {projectId} 替換為實際的 Project ID
-url = f"https://cloud.getwren.ai/api/v1/projects/{PROJECT_ID}"
+base_url = "https://cloud.getwren.ai/api/v1"
+url = f"/projects/{PROJECT_ID}"
 
 # 設置 Headers，必須包含 Authorization (Bearer Token)
 headers = {
@@ -16,11 +17,13 @@ headers = {
     "Authorization": f"Bearer {WREN_API_KEY}" 
 }
 
-print(f"嘗試請求 URL: {url}")
+print(f"嘗試請求 URL: {base_url}{url}")
 
 # --- 執行 GET 請求 ---
 try:
-    response = requests.get(url, headers=headers, timeout=10)
+    # 使用同一個 Client (連線池 + HTTP/2)，多次呼叫時可重用連線
+    with httpx.Client(base_url=base_url, headers=headers, http2=True, timeout=10.0) as client:
+        response = client.get(url)
     status_code = response.status_code
 
     if 200 <= status_code < 300:
@@ -42,5 +45,5 @@ try:
         except json.JSONDecodeError:
             print("無法解析 JSON，原始文本:", response.text)
 
-except requests.exceptions.RequestException as e:
+except httpx.HTTPError as e:
     print(f"\n⚠️ 發生網絡或連線錯誤: {e}")
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+
+import httpx
+import pytest
+from cachetools import TTLCache
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    """以 MockTransport 取代上游 Wren API，回傳建立 (TestClient, 上游收到的請求) 的函式。"""
+    seen = []
+
+    def make(handler):
+        def record(request):
+            seen.append(request)
+            return handler(request)
+
+        transport = httpx.MockTransport(record)
+        monkeypatch.setattr(main, "CLIENT", httpx.AsyncClient(base_url=main.WREN_BASE_URL, transport=transport))
+        monkeypatch.setattr(main, "_validate_cache", TTLCache(maxsize=1024, ttl=60))
+        return TestClient(main.app), seen
+
+    return make
+
+
+def _collect_stream(parts, pause=0.0):
+    """依序送出 parts 作為上游 SSE 讀取 (每次讀取間隔 pause 秒)，回傳讀取與 yield 的先後紀錄。"""
+    log = []
+
+    class UpstreamStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            for i, part in enumerate(parts):
+                if i and pause:
+                    await asyncio.sleep(pause)
+                log.append(("read", i))
+                yield part
+
+    def handler(request):
+        return httpx.Response(200, stream=UpstreamStream())
+
+    async def run():
+        original = main.CLIENT
+        main.CLIENT = httpx.AsyncClient(base_url=main.WREN_BASE_URL, transport=httpx.MockTransport(handler))
+        try:
+            async for chunk in main.stream_wren_response("/stream/ask", {}, "key"):
+                log.append(("yield", chunk))
+        finally:
+            await main.CLIENT.aclose()
+            main.CLIENT = original
+
+    asyncio.run(run())
+    return log
+
+
+def test_stream_flushes_event_terminator_split_across_reads():
+    log = _collect_stream([b"data: a\n", b"\ndata: b", b"\n\n"])
+
+    # 事件 a 在第二次讀取後就已完整，必須在第三次讀取前送出
+    assert log == [
+        ("read", 0),
+        ("read", 1),
+        ("yield", b"data: a\n\ndata: b"),
+        ("read", 2),
+        ("yield", b"\n\n"),
+    ]
+
+
+def test_stream_flushes_terminator_split_around_previous_flush():
+    log = _collect_stream([b"data: a\n\ndata: b\n", b"\n", b"data: c\n\n"])
+
+    assert log == [
+        ("read", 0),
+        ("yield", b"data: a\n\ndata: b\n"),
+        ("read", 1),
+        ("yield", b"\n"),
+        ("read", 2),
+        ("yield", b"data: c\n\n"),
+    ]
+
+
+def test_stream_coalesces_partial_event():
+    log = _collect_stream([b"data: ", b"{\"a\"", b":1}\n\n"])
+
+    assert [entry for entry in log if entry[0] == "yield"] == [("yield", b"data: {\"a\":1}\n\n")]
+
+
+def test_stream_flushes_crlf_and_cr_terminated_events():
+    log = _collect_stream([b"data: a\r\n\r\n", b"data: b\r\n", b"\r\n", b"data: c\r\r"])
+
+    assert log == [
+        ("read", 0),
+        ("yield", b"data: a\r\n\r\n"),
+        ("read", 1),
+        ("read", 2),
+        ("yield", b"data: b\r\n\r\n"),
+        ("read", 3),
+        ("yield", b"data: c\r\r"),
+    ]
+
+
+def test_stream_flushes_held_data_after_interval():
+    # 沒有事件結尾的資料 (例如 NDJSON) 也不能被無限期暫留，須在下一次讀取前逾時送出
+    log = _collect_stream([b'{"n": 1}\n', b'{"n": 2}\n'], pause=main.STREAM_FLUSH_INTERVAL * 40)
+
+    assert log == [
+        ("read", 0),
+        ("yield", b'{"n": 1}\n'),
+        ("read", 1),
+        ("yield", b'{"n": 2}\n'),
+    ]
+
+
+def test_wren_request_strips_only_project_id():
+    request = main.WrenRequest(project_id=" 11237 ", text=" total sales ", additional_payload={" k ": " v "})
+
+    assert request.project_id == "11237"
+    assert request.text == " total sales "
+    assert request.additional_payload == {" k ": " v "}
+
+
+@pytest.mark.parametrize("endpoint_path", [
+    "http://internal.svc/admin",
+    "http:%2F%2F169.254.169.254%2Flatest%2Fmeta-data",
+    "/internal.svc/admin",
+    "%2F%2Finternal.svc/admin",
+])
+@pytest.mark.parametrize("route", ["/api/wren-call/", "/api/stream-call/"])
+def test_proxy_routes_stay_on_wren_host(proxy, route, endpoint_path):
+    client, seen = proxy(lambda request: httpx.Response(200, json={}))
+
+    client.post(
+        route + endpoint_path,
+        headers={"X-Wren-API-Key": "key"},
+        json={"project_id": "1", "text": "hi"},
+    )
+
+    assert len(seen) == 1
+    assert seen[0].url.host == "cloud.getwren.ai"
+    assert seen[0].url.path.startswith("/api/v1/")
+
+
+def test_validate_key_caches_success(proxy):
+    client, seen = proxy(lambda request: httpx.Response(200, json={"id": 1}))
+    headers = {"X-Wren-API-Key": "key"}
+
+    first = client.get("/api/validate-key?project_id=1", headers=headers)
+    second = client.get("/api/validate-key?project_id= 1 ", headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json() == {"id": 1}
+    # 第二次驗證由快取回應，不再呼叫上游
+    assert len(seen) == 1
+
+
+def test_validate_key_does_not_cache_errors(proxy):
+    client, seen = proxy(lambda request: httpx.Response(401, json={"error": "unauthorized"}))
+    headers = {"X-Wren-API-Key": "bad-key"}
+
+    for _ in range(2):
+        response = client.get("/api/validate-key?project_id=1", headers=headers)
+        assert response.status_code == 401
+
+    assert len(seen) == 2
+    assert len(main._validate_cache) == 0
+
+
+@pytest.mark.parametrize("route", ["/api/wren-call/generate_sql", "/api/stream-call/stream/ask"])
+def test_proxy_rejects_reserved_keys_in_additional_payload(proxy, route):
+    client, seen = proxy(lambda request: httpx.Response(200, json={}))
+
+    response = client.post(
+        route,
+        headers={"X-Wren-API-Key": "key"},
+        json={"project_id": "1", "text": "hi", "additional_payload": {"projectId": 2, "sql": "select 1"}},
+    )
+
+    assert response.status_code == 400
+    assert "projectId" in response.json()["detail"]
+    assert seen == []
+
+
+@pytest.mark.parametrize("route", ["/api/wren-call/generate_sql", "/api/stream-call/stream/ask"])
+def test_proxy_forwards_integers_beyond_64_bits(proxy, route):
+    client, seen = proxy(lambda request: httpx.Response(200, stream=httpx.ByteStream(b"data: {}\n\n")))
+
+    response = client.post(
+        route,
+        headers={"X-Wren-API-Key": "key"},
+        json={"project_id": "1", "text": "中文", "additional_payload": {"n": 2**70}},
+    )
+
+    assert response.status_code == 200
+    assert b"event: error" not in response.content
+    # orjson 無法編碼時改用標準 json，數值與非 ASCII 文字都須原樣送出
+    assert b'"n":1180591620717411303424' in seen[0].content
+    assert "中文".encode() in seen[0].content